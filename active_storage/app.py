@@ -1,14 +1,20 @@
-import json
+import asyncio
+import contextlib
+import functools
+from collections import Counter, OrderedDict, deque
 
-from fastapi import FastAPI, HTTPException, Depends
-from fastapi.responses import Response, JSONResponse
+from fastapi import FastAPI, HTTPException, Depends, Request
+from fastapi.responses import Response, JSONResponse, StreamingResponse
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 
 import botocore
 import aioboto3
+from aiobotocore.config import AioConfig
 import numpy as np
 
-from .models import RequestData, AllowedReductions, AllowedDatatypes, REDUCERS
+from .config import settings
+from .kernels import compile_kernels
+from .models import RequestData, AllowedReductions, AllowedDatatypes, Reducer, REDUCERS
 
 
 app = FastAPI()
@@ -49,137 +55,594 @@ async def handle_upstream_s3_exception(request, exc: S3Exception):
 
 
 
-def validate_request(request_data: RequestData):
+@app.on_event('startup')
+async def warm_up_kernels():
+    """ Compiles the reduction kernels before serving the first request """
+    compile_kernels(AllowedDatatypes)
+
+
+#Size the connection pool so concurrent range requests from many
+# requests sharing a cached client don't queue for a connection
+s3_client_config = AioConfig(
+    max_pool_connections=settings.max_pool_connections,
+    connect_timeout=settings.connect_timeout,
+    read_timeout=settings.read_timeout,
+    connector_args={'keepalive_timeout': settings.keepalive_timeout},
+)
+
+
+class S3ClientCache:
     """
-    Checks that the supplied request data confroms to the API spec
-    and tries to provide informative error messages if not.
+    Cache of S3 clients shared between requests so that connection pools
+    are reused rather than rebuilt per request. All clients are created
+    from a single shared session. Only the most recently used clients are
+    kept, and a client dropped from the cache is closed as soon as no
+    request is using it.
     """
-    dtype = request_data.dtype
-    offset = request_data.offset
-    n_bytes = AllowedDatatypes[dtype].n_bytes()
 
-    if offset is not None and (offset < 0 or offset % n_bytes != 0):
-        msg = ' '.join([
-            'Offset parameter must be divisible by number of bytes in dtype',
-            f'(i.e. {n_bytes} for dtype {dtype}).',
-            f'Given offset = {request_data.offset}',
-        ])
-        raise HTTPException(status_code=400, detail=msg)
-        pass
+    def __init__(self):
+        self.session = aioboto3.Session()
+        #Ordered from least to most recently used
+        self.clients = OrderedDict()
+        self.locks = {}
+        #Number of requests using each client and clients waiting for theirs to finish
+        self.users = Counter()
+        self.evicted = set()
+
+    async def acquire(self, source: str, credentials: HTTPBasicCredentials):
+        """
+        Returns the client for the given source and credentials, creating
+        one on first use, and marks it as in use until it's released.
+        """
+        # Key on the full credentials so that a request can never borrow
+        # a client authenticated with someone else's secret key
+        key = (source, credentials.username, credentials.password)
+        s3_client = self.clients.get(key)
+        if s3_client is None:
+            # Guard creation so that concurrent requests don't each build a client
+            lock = self.locks.setdefault(key, asyncio.Lock())
+            try:
+                async with lock:
+                    s3_client = self.clients.get(key)
+                    if s3_client is None:
+                        s3_client = await self.session.client(
+                            's3',
+                            endpoint_url=source,
+                            aws_access_key_id=credentials.username,
+                            aws_secret_access_key=credentials.password,
+                            config=s3_client_config,
+                        ).__aenter__()
+                        self.clients[key] = s3_client
+            finally:
+                # Later requests find the client (or retry a failed creation)
+                # so only current waiters need the lock
+                if self.locks.get(key) is lock:
+                    del self.locks[key]
+        self.clients.move_to_end(key)
+        self.users[s3_client] += 1
+
+        idle = []
+        while len(self.clients) > settings.max_cached_clients:
+            _, old_client = self.clients.popitem(last=False)
+            if self.users[old_client]:
+                self.evicted.add(old_client)
+            else:
+                idle.append(old_client)
+        for old_client in idle:
+            await old_client.__aexit__(None, None, None)
+
+        return s3_client
+
+    async def release(self, s3_client):
+        """ Marks a client as no longer in use by a request """
+        self.users[s3_client] -= 1
+        if self.users[s3_client] <= 0:
+            del self.users[s3_client]
+            if s3_client in self.evicted:
+                self.evicted.remove(s3_client)
+                await s3_client.__aexit__(None, None, None)
+
+    @contextlib.asynccontextmanager
+    async def client(self, source: str, credentials: HTTPBasicCredentials):
+        """ Context manager which uses a cached client for the duration of a request """
+        s3_client = await self.acquire(source, credentials)
+        try:
+            yield s3_client
+        finally:
+            await self.release(s3_client)
 
-    elif request_data.order not in ['C', 'F']:
-        msg = f"'order' parameter was '{request_data.order}' but must be either 'C' or 'F'"
-        raise HTTPException(status_code=400, detail=msg)
+    async def close(self):
+        """ Closes all cached clients and their connection pools """
+        for s3_client in [*self.clients.values(), *self.evicted]:
+            await s3_client.__aexit__(None, None, None)
+        self.clients.clear()
+        self.evicted.clear()
 
-    elif request_data.shape is None and request_data.selection is not None:
-        msg = 'When providing a selection parameter you must also provide an shape parameter'
-        raise HTTPException(status_code=400, detail=msg)
 
-    elif request_data.shape is not None:
+@app.on_event('startup')
+async def init_s3_clients():
+    """ Sets up the S3 client cache shared between requests """
+    app.state.s3_clients = S3ClientCache()
 
-        if request_data.selection and len(request_data.shape) != len(request_data.selection):
-            raise HTTPException(
-                status_code=400,
-                detail='Selection parameter list must have same number of elements as shape parameter'
-            )
 
-    return
+@app.on_event('shutdown')
+async def close_s3_clients():
+    """ Closes any cached S3 clients """
+    await app.state.s3_clients.close()
 
 
-async def upstream_s3_response(request_data: RequestData, credentials: HTTPBasicCredentials):
+def get_s3_clients(request: Request) -> S3ClientCache:
+    """ Dependency providing the shared S3 client cache """
+    return request.app.state.s3_clients
 
-    s3_session = aioboto3.Session()
 
-    async with s3_session.client(
-        's3', 
-        endpoint_url=request_data.source, 
-        aws_access_key_id=credentials.username, 
-        aws_secret_access_key=credentials.password
-    ) as s3_client:
+def split_range(start: int, stop: int):
+    """ Splits the byte range [start, stop) into chunks of at most the configured chunk size """
+    return [
+        (chunk_start, min(chunk_start + settings.chunk_size, stop))
+        for chunk_start in range(start, stop, settings.chunk_size)
+    ]
 
-        try:
-            #Use the HTTP Range header to fetch only the bytes we need
-            bytes_start = request_data.offset or 0
-            bytes_end = '' #Use empty string to default to open-ended range request
-            if request_data.size is not None:
-                #Subtract 1 since bytes ranges are inclusive
-                bytes_end = bytes_start + request_data.size - 1
-            response = await s3_client.get_object(
-                Bucket=request_data.bucket, 
-                Key=request_data.object, 
-                Range=f'bytes={bytes_start}-{bytes_end}'
-            )
-            response_data = await response['Body'].read()
-        
-        except botocore.exceptions.ClientError as err:
-            raise S3Exception(err.response)
-
-        except botocore.exceptions.EndpointConnectionError as err:
-            # Create S3-like error dict to be parsed by exception handler
-            error_info = {
-                'Error': {
-                    'Code': 'UpstreamSourceNotFound',
-                    'Message': 'Could not connect to configured S3 source',
-                    'Resource': 'N/A'
-                },
-                'ResponseMetadata': {
-                    'HTTPStatusCode': 404
-                }
-            }
-            raise S3Exception(error_info)        
-        return response_data #Bytes format
 
+def generate_bytes_ranges(request_data: RequestData):
+    """
+    Works out which bytes (relative to the requested offset) hold the selected
+    elements, merging elements which are close together into contiguous runs
+    so that a sparse selection is fetched with a few range requests rather
+    than reading every byte. Returns None if the whole range should be fetched.
+    """
+    # An empty selection selects the whole array, as does an empty index with numpy
+    if not request_data.selection or any(step == 0 for _, _, step in request_data.selection):
+        return None
+    # Only fetch sparsely when the size pins down exactly the bytes covered by the
+    # shape, otherwise leave the full fetch to report any mismatch between the two
+    shape = request_data.shape
+    n_bytes = request_data.dtype.n_bytes()
+    if request_data.size != int(np.prod(shape)) * n_bytes:
+        return None
+    ranges = selection_byte_ranges(
+        request_data.dtype,
+        request_data.order,
+        tuple(shape),
+        tuple(map(tuple, request_data.selection)),
+    )
+    # Many small requests take longer than reading through the gaps between
+    # them, so fall back to the full fetch when the selection is too scattered
+    # (or when nothing is selected, to leave it to check the shape)
+    full_fetch_requests = -(-request_data.size // settings.chunk_size)
+    if (
+        not ranges
+        or len(ranges) > settings.max_selection_ranges
+        or len(ranges) > settings.selection_range_factor * full_fetch_requests
+    ):
+        return None
+    return ranges
+
+
+#The ranges depend only on the structure of the request, so repeating a selection
+# (e.g. the same slice of every time step) on any object of that shape is a lookup
+@functools.lru_cache(maxsize=128)
+def selection_byte_ranges(dtype: AllowedDatatypes, order: str, shape, selection):
+    """ Returns the coalesced (start, stop) byte ranges holding the selected elements """
+    n_bytes = dtype.n_bytes()
+
+    # Order the axes from slowest to fastest varying in memory
+    axes = list(zip(selection, shape))
+    if order == 'F':
+        axes.reverse()
+    # Number of bytes between consecutive indices along each axis
+    dims = [n for _, n in axes]
+    strides = np.cumprod([n_bytes] + dims[:0:-1])[::-1]
+
+    # Build the runs up one axis at a time from the fastest varying, starting
+    # from a single element. At each axis the runs covering the faster axes
+    # are repeated at each selected index then merged wherever they're close
+    # enough together, so a dense selection stays a handful of runs rather
+    # than ever materialising an offset for every selected element. Since
+    # the repeats are in ascending order, the runs never need sorting.
+    run_starts = np.zeros(1, dtype=np.int64)
+    run_stops = np.full(1, n_bytes, dtype=np.int64)
+    for (s, n), stride in zip(reversed(axes), strides[::-1]):
+        axis = np.arange(*slice(*s).indices(n), dtype=np.int64) * stride
+        if axis.size == 0:
+            return ()
+        run_starts = (axis[:, np.newaxis] + run_starts).ravel()
+        run_stops = (axis[:, np.newaxis] + run_stops).ravel()
+        # Start a new run wherever the gap to the next one is too big to be worth reading through
+        breaks = np.flatnonzero(run_starts[1:] - run_stops[:-1] > settings.coalesce_gap) + 1
+        run_starts = run_starts[np.concatenate(([0], breaks))]
+        run_stops = run_stops[np.concatenate((breaks - 1, [run_stops.size - 1]))]
+
+    # Return a tuple so the cached value can't be modified by a caller
+    return tuple(
+        chunk
+        for run_start, run_stop in zip(run_starts.tolist(), run_stops.tolist())
+        for chunk in split_range(run_start, run_stop)
+    )
 
 
-class OctetStreamResponse(Response):
-    """ 
-    Dummy response class which ensures that OpenAPI generated 
-    schema have correct response type for handler functions 
+async def iter_object_ranges(
+        s3_client,
+        request_data: RequestData,
+        ranges,
+        ordered: bool = True,
+        first_response=None
+    ):
     """
-    media_type = 'application/octet-stream'
+    Requests each [start, stop) byte range (relative to the requested offset)
+    of the S3 object concurrently and yields (start, chunk) pairs, either in
+    order or, if the consumer doesn't need that, as soon as each arrives.
+    If given, first_response is an already started request for the first range.
+    """
+    offset = request_data.offset or 0
+
+    async def fetch_chunk(chunk_start, chunk_stop, response=None):
+        if response is None:
+            try:
+                response = await s3_client.get_object(
+                    Bucket=request_data.bucket, 
+                    Key=request_data.object, 
+                    Range=f'bytes={offset + chunk_start}-{offset + chunk_stop - 1}'
+                )
+            except botocore.exceptions.ClientError as err:
+                # A later range starting past the end of the object just means the requested
+                # size was too big, which a single request would have silently truncated
+                if chunk_start > 0 and err.response.get('ResponseMetadata', {}).get('HTTPStatusCode') == 416:
+                    return chunk_start, chunk_stop, b''
+                raise
+        return chunk_start, chunk_stop, await response['Body'].read()
+
+    # Only keep a window of ranges in flight (or fetched but not yet consumed)
+    # ahead of the consumer, so a slow consumer can't make us hold the whole
+    # object in memory. Each range taken off the window is replaced by the next.
+    remaining = iter(ranges)
+    window = deque()
+
+    def schedule_next():
+        next_range = next(remaining, None)
+        if next_range is not None:
+            window.append(asyncio.ensure_future(fetch_chunk(*next_range)))
+
+    def stop_scheduling():
+        # Ranges are in ascending order, so once one runs past the end of the
+        # object so do all the rest and there's no point requesting them
+        nonlocal remaining
+        remaining = iter(())
+
+    if first_response is not None:
+        window.append(asyncio.ensure_future(fetch_chunk(*next(remaining), first_response)))
+    for _ in range(settings.max_concurrency - len(window)):
+        schedule_next()
+    try:
+        while window:
+            if ordered:
+                task = window.popleft()
+            else:
+                done, _ = await asyncio.wait(window, return_when=asyncio.FIRST_COMPLETED)
+                task = done.pop()
+                window.remove(task)
+            chunk_start, chunk_stop, chunk = await task
+            if len(chunk) < chunk_stop - chunk_start:
+                stop_scheduling()
+            schedule_next()
+            if chunk:
+                yield chunk_start, chunk
+    finally:
+        # Don't leave requests running if the consumer stops early or a fetch fails
+        for task in window:
+            task.cancel()
+
+
+@contextlib.contextmanager
+def upstream_s3_errors():
+    """ Converts errors from the upstream S3 source into S3Exceptions """
+    try:
+        yield
+
+    except botocore.exceptions.ClientError as err:
+        raise S3Exception(err.response)
+
+    except botocore.exceptions.EndpointConnectionError as err:
+        # Create S3-like error dict to be parsed by exception handler
+        error_info = {
+            'Error': {
+                'Code': 'UpstreamSourceNotFound',
+                'Message': 'Could not connect to configured S3 source',
+                'Resource': 'N/A'
+            },
+            'ResponseMetadata': {
+                'HTTPStatusCode': 404
+            }
+        }
+        raise S3Exception(error_info)        
 
 
+def object_length(response):
+    """ Returns the total length of the object from a range response's Content-Range header """
+    # e.g. 'bytes 0-1023/4096'
+    try:
+        return int(response['ContentRange'].rpartition('/')[2])
+    except (KeyError, ValueError):
+        return None
 
-@app.post('/v1/{operation_name}/', response_class=OctetStreamResponse)
-async def handler(
-        operation_name: AllowedReductions, 
+
+async def upstream_s3_response(
+        s3_client,
         request_data: RequestData,
-        credentials=Depends(security)
+        ranges=None,
+        ordered: bool = True
     ):
+    """
+    Starts fetching the requested bytes from the upstream S3 source, either
+    for the full requested range or only the given ranges, and returns the
+    number of bytes to expect along with an iterator of (position, chunk)
+    pairs. Chunks are only guaranteed to arrive in order if `ordered` is set.
+
+    Rather than finding the object size with a separate HEAD request first,
+    the first chunk is requested straight away and the length of the object
+    is read from its Content-Range, so that a full fetch can be split into
+    concurrent requests which stop at the end of the object. Some S3
+    implementations stage the whole object to serve an open-ended range
+    request, so every request is bounded.
+    """
+    offset = request_data.offset or 0
+    if ranges is None:
+        first = (0, settings.chunk_size if request_data.size is None else min(request_data.size, settings.chunk_size))
+    else:
+        first = ranges[0]
+
+    with upstream_s3_errors():
+        response = await s3_client.get_object(
+            Bucket=request_data.bucket, 
+            Key=request_data.object, 
+            Range=f'bytes={offset + first[0]}-{offset + first[1] - 1}'
+        )
+
+    length = object_length(response)
+    if length is None:
+        # Without the object length, assume the object ends where this response does
+        length = offset + first[0] + response['ContentLength']
+    size = length - offset if request_data.size is None else min(request_data.size, length - offset)
+    if ranges is None:
+        ranges = [first] + split_range(first[1], size)
+    elif size < request_data.size:
+        # Check the object really holds the requested size before the caller
+        # allocates a buffer for it, rather than trusting the request
+        raise HTTPException(status_code=400, detail='Requested size exceeds the size of the S3 object')
+
+    async def chunks():
+        with upstream_s3_errors():
+            async for position, chunk in iter_object_ranges(s3_client, request_data, ranges, ordered, response):
+                yield position, chunk #Bytes format
+
+    return size, chunks()
+
+
+async def read_into_buffer(chunks, size: int, ranges=None):
+    """
+    Reads all chunks into a single preallocated, writable buffer which numpy
+    can wrap without copying. The size must be one the object is known to
+    hold (i.e. from upstream_s3_response) rather than one from the request.
+    If only some ranges were fetched, the bytes between them are left zeroed.
+    """
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    filled = received = 0
+    async for position, chunk in chunks:
+        view[position:position + len(chunk)] = chunk
+        filled = max(filled, position + len(chunk))
+        received += len(chunk)
+    view.release()
+
+    if ranges is not None:
+        if received != sum(stop - start for start, stop in ranges):
+            raise HTTPException(status_code=400, detail='Requested size exceeds the size of the S3 object')
+    else:
+        # Object may have been shorter than the requested size
+        del buffer[filled:]
+    return buffer
+
+
+async def stream_reduce(chunks, dtype: AllowedDatatypes, reducer: Reducer):
+    """
+    Applies the reduction to each chunk as it arrives and folds the partial
+    results together, so the full object is never held in memory at once.
+    """
+    n_bytes = dtype.n_bytes()
+    np_dtype = dtype.np_dtype()
+    #Resolve the reducer's functions once so each block calls them directly
+    reduce_chunk, start, combine = reducer.reduce_chunk, reducer.start, reducer.combine
+    accumulate = reducer.accumulate or (lambda acc, arr: combine(acc, reduce_chunk(arr)))
+    result = None
+
+    def reduce_whole_items(buffer):
+        """ Reduces all whole elements in the buffer and returns the number of bytes used """
+        nonlocal result
+        n_items = len(buffer) // n_bytes
+        if n_items > 0:
+            arr = np.frombuffer(buffer, dtype=np_dtype, count=n_items)
+            result = start(reduce_chunk(arr)) if result is None else accumulate(result, arr)
+        return n_items * n_bytes
+
+    # Small chunks are gathered into a block before reducing so that each
+    # reduction works over enough data to amortise its overhead. This also
+    # carries partial elements over when chunk boundaries don't line up with
+    # element boundaries. Chunks may arrive out of order, but then each
+    # starts on an element boundary and the block can simply be flushed.
+    block = bytearray()
+    next_position = 0
+    async for position, chunk in chunks:
+        if position != next_position:
+            used = reduce_whole_items(block)
+            block = block[used:]
+            if block:
+                break
+        next_position = position + len(chunk)
+
+        if not block and len(chunk) >= settings.reduce_block_size:
+            # Big enough to reduce in place without copying it into the block
+            used = reduce_whole_items(chunk)
+            block += chunk[used:]
+        else:
+            block += chunk
+            if len(block) >= settings.reduce_block_size:
+                used = reduce_whole_items(block)
+                block = block[used:]
+
+    used = reduce_whole_items(block)
+    if len(block) > used:
+        msg = f'Size of data fetched from S3 is not a multiple of {n_bytes} bytes for dtype {dtype.value}'
+        raise HTTPException(status_code=400, detail=msg)
 
-    # Will return a relevant HTTP response to the client if request is invalid
-    validate_request(request_data)
+    if result is None:
+        # Empty object so reduce an empty array to get consistent behaviour
+        return reducer.reduce(np.empty(0, dtype=np_dtype))
+    return reducer.finalise(result, np_dtype)
 
-    # Look up required function in dict
-    reduction_func = REDUCERS[operation_name]
 
-    # Fetch upstream response and wrangle it into desired format
-    response_data = await upstream_s3_response(request_data, credentials)
-    response_arr = np.frombuffer(response_data, dtype=request_data.dtype)
+def stream_through(chunks, stack: contextlib.AsyncExitStack):
+    """
+    Returns an iterator which passes the bytes of every chunk on unchanged,
+    keeping whatever is on the given exit stack (e.g. the S3 client in use)
+    until it finishes.
+    """
+    cleanup = stack.pop_all()
+
+    async def body():
+        async with cleanup:
+            async for _, chunk in chunks:
+                yield chunk
 
-    shape = request_data.shape or response_arr.shape
-    try:
-        response_arr = response_arr.reshape(shape, order=request_data.order)
-    except ValueError as err:
-        raise HTTPException(status_code=400, detail=str(err).replace('array', 'chunk'))
+    return body()
 
-    if request_data.selection is not None:
-        slices = tuple(slice(*s) for s in request_data.selection)
-        response_arr = response_arr[slices]
 
-    # Perform main reduction
-    result = reduction_func(response_arr)
 
-    response_headers = {
+def encode_result(result, order: str):
+    """ Returns the response content and headers for a reduction result """
+    headers = {
         'x-activestorage-dtype': str(result.dtype),
-        'x-activestorage-shape': json.dumps(list(result.shape)),
+        # Same output as json.dumps(list(result.shape)) without the encoder overhead
+        'x-activestorage-shape': '[' + ', '.join(map(str, result.shape)) + ']',
     }
 
-    return Response(
+    if result.ndim > 1:
         # Make sure to return result in same bytes order input
-        content=result.tobytes(order=request_data.order),
-        status_code=200, 
-        media_type='application/octet-stream', 
-        headers=response_headers
-    )
+        content = result.tobytes(order=order)
+    else:
+        # Order is irrelevant for scalar and 1D results
+        content = result.tobytes()
+
+    return content, headers
+
+
+@functools.lru_cache(maxsize=512)
+def build_pipeline(operation_name: AllowedReductions, dtype: AllowedDatatypes, order: str, shape, selection):
+    """
+    Builds the function which turns a buffered upstream response into the
+    response content and headers. Everything that depends only on the
+    structure of the request (rather than the data) is worked out once here,
+    and cached, so repeated requests of the same form skip it entirely.
+    """
+    reducer = REDUCERS[operation_name]
+    np_dtype = dtype.np_dtype()
+    slices = None if selection is None else tuple(slice(*s) for s in selection)
+    # Gather strided selections into contiguous memory so the reduction walks
+    # sequential memory (select skips this as tobytes does the same gather)
+    gather = None
+    if operation_name != AllowedReductions.select:
+        gather = np.asfortranarray if order == 'F' else np.ascontiguousarray
+
+    def pipeline(buffer):
+        arr = np.frombuffer(buffer, dtype=np_dtype)
+
+        # Reshaping a flat buffer never copies (even for 'F' order) but skip it when it's a no-op
+        if shape is not None and shape != arr.shape:
+            try:
+                arr = arr.reshape(shape, order=order)
+            except ValueError as err:
+                raise HTTPException(status_code=400, detail=str(err).replace('array', 'chunk'))
+
+        if slices is not None:
+            arr = arr[slices]
+            if gather is not None and not (arr.flags.c_contiguous or arr.flags.f_contiguous):
+                arr = gather(arr)
+
+        return encode_result(reducer.reduce(arr), order)
+
+    return pipeline
+
+
 
+class OctetStreamResponse(Response):
+    """ 
+    Dummy response class which ensures that OpenAPI generated 
+    schema have correct response type for handler functions 
+    """
+    media_type = 'application/octet-stream'
+
+
+
+@app.post('/v1/{operation_name}/', response_class=OctetStreamResponse)
+async def handler(
+        operation_name: AllowedReductions, 
+        request_data: RequestData,
+        credentials=Depends(security),
+        s3_clients: S3ClientCache = Depends(get_s3_clients)
+    ):
+
+    # Look up required reducer in dict
+    reducer = REDUCERS[operation_name]
+
+    # The client stays in use until the response is complete
+    async with contextlib.AsyncExitStack() as stack:
+        s3_client = await stack.enter_async_context(s3_clients.client(request_data.source, credentials))
+
+        if operation_name == AllowedReductions.select and request_data.shape is None and request_data.selection is None:
+            # Selecting a whole flat range is a byte for byte copy of the upstream
+            # response, so pass it on as it arrives rather than buffering it all
+            size, chunks = await upstream_s3_response(s3_client, request_data)
+            n_bytes = request_data.dtype.n_bytes()
+            if size % n_bytes != 0:
+                msg = f'Size of data fetched from S3 is not a multiple of {n_bytes} bytes for dtype {request_data.dtype.value}'
+                raise HTTPException(status_code=400, detail=msg)
+            return StreamingResponse(
+                stream_through(chunks, stack),
+                status_code=200,
+                media_type='application/octet-stream',
+                headers={
+                    'x-activestorage-dtype': request_data.dtype.value,
+                    'x-activestorage-shape': f'[{size // n_bytes}]',
+                    # Lets the client detect a truncated response if the object changes while streaming
+                    'content-length': str(size),
+                },
+            )
+
+        if request_data.shape is None and request_data.selection is None and reducer.streamable:
+            # Reduce the upstream response as it arrives rather than buffering it
+            ordered = not reducer.is_order_independent(request_data.dtype.np_dtype())
+            _, chunks = await upstream_s3_response(s3_client, request_data, ordered=ordered)
+            result = await stream_reduce(chunks, request_data.dtype, reducer)
+            content, response_headers = encode_result(result, request_data.order)
+
+        else:
+            pipeline = build_pipeline(
+                operation_name,
+                request_data.dtype,
+                request_data.order,
+                None if request_data.shape is None else tuple(request_data.shape),
+                None if request_data.selection is None else tuple(map(tuple, request_data.selection)),
+            )
+            # Fetch upstream response (or just the parts holding the selected
+            # elements) and wrangle it into desired format
+            ranges = generate_bytes_ranges(request_data)
+            # Each chunk is written to its own position in the buffer so order doesn't matter
+            size, chunks = await upstream_s3_response(s3_client, request_data, ranges, ordered=False)
+            response_data = await read_into_buffer(chunks, size, ranges)
+            content, response_headers = pipeline(response_data)
+
+        return Response(
+            content=content,
+            status_code=200, 
+            media_type='application/octet-stream', 
+            headers=response_headers
+        )
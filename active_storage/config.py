@@ -0,0 +1,46 @@
+from pydantic import BaseSettings, validator
+
+
+class Settings(BaseSettings):
+    """
+    Tunable settings for the active storage proxy, which can be
+    overridden using ACTIVE_STORAGE_* environment variables.
+    """
+    #Size in bytes of each range request used when fetching large objects
+    chunk_size: int = 8 * 1024 * 1024
+    #Maximum number of range requests in flight (or fetched but not yet
+    # consumed) for a single fetch
+    max_concurrency: int = 16
+    #Minimum number of bytes gathered from the upstream response before
+    # reducing them when streaming a reduction
+    reduce_block_size: int = 1024 * 1024
+    #Largest gap in bytes between selected elements which is read through
+    # rather than starting a new range request
+    coalesce_gap: int = 16 * 1024
+    #Selections needing more range requests than this are fetched in full instead
+    max_selection_ranges: int = 64
+    #Selections needing more than this many times as many range requests as
+    # fetching the full range are fetched in full instead
+    selection_range_factor: float = 4.0
+    #Maximum number of S3 clients (one per source and credentials) kept for reuse
+    max_cached_clients: int = 32
+    #Maximum number of pooled connections kept by each cached S3 client
+    max_pool_connections: int = 128
+    #Seconds an idle pooled connection is kept alive for reuse
+    keepalive_timeout: float = 30.0
+    #Timeouts in seconds for connecting to and reading from the S3 source
+    connect_timeout: float = 5.0
+    read_timeout: float = 30.0
+
+    @validator('chunk_size')
+    def check_chunk_size(cls, v):
+        #Keep range boundaries aligned to elements of every supported dtype
+        if v < 8 or v % 8 != 0:
+            raise ValueError('chunk_size must be a positive multiple of 8 bytes')
+        return v
+
+    class Config:
+        env_prefix = 'ACTIVE_STORAGE_'
+
+
+settings = Settings()
@@ -0,0 +1,179 @@
+"""
+JIT-compiled kernels for the hot reduction operations.
+
+Numba is an optional dependency (install with the 'jit' extra); when it
+is not available every kernel falls back to the equivalent numpy call.
+"""
+import numpy as np
+
+try:
+    from numba import njit, prange, from_dtype, types
+except ImportError:
+    njit = None
+
+
+def _sum_accumulator(dtype):
+    """
+    Returns a zero of the type used to accumulate a sum of the given dtype.
+    Floats are always summed in double precision, so float32 data keeps its
+    compact encoding on the wire without losing precision over long streams.
+    """
+    if dtype.kind == 'f':
+        return np.float64(0)
+    return dtype.type(0)
+
+
+def _mean_accumulator(dtype):
+    """ Returns a zero of the type used to accumulate a mean of the given dtype """
+    if dtype.kind == 'i':
+        return np.int64(0)
+    if dtype.kind == 'u':
+        return np.uint64(0)
+    return np.float64(0)
+
+
+def _as_dtype(value, dtype):
+    """
+    Casts a kernel result to the given dtype. numba widens small integers
+    while summing, so this wraps on overflow the same way numpy would.
+    """
+    return np.asarray(value).astype(dtype)[()]
+
+
+def _numpy_sum(arr):
+    return arr.dtype.type(np.sum(arr, dtype=_sum_accumulator(arr.dtype).dtype))
+
+
+def _numpy_mean(arr):
+    # Sum with a widened accumulator to avoid integer overflow and float rounding
+    return (arr.sum(dtype=_mean_accumulator(arr.dtype).dtype) / arr.size).astype(arr.dtype, copy=False)
+
+
+def _flatten(arr):
+    """
+    Returns a flat view of the array if it is contiguous in memory (in either
+    C or F order) or None if the kernels can't be applied to it directly.
+    """
+    if arr.size == 0 or not (arr.flags.c_contiguous or arr.flags.f_contiguous):
+        return None
+    return arr.ravel(order='K')
+
+
+if njit is not None:
+
+    # Only allow reassociation (so LLVM can vectorise the loop) rather than
+    # full fastmath, which would also let it assume there are no NaNs
+    @njit(cache=True, parallel=True, fastmath={'reassoc', 'contract'})
+    def _sum(arr, initial):
+        total = initial
+        for i in prange(arr.size):
+            total += arr[i]
+        return total
+
+    # Not parallel since numba's parallel min/max skip NaNs, whereas numpy
+    # (and the serial kernels) propagate them
+    @njit(cache=True)
+    def _min(arr):
+        return arr.min()
+
+    @njit(cache=True)
+    def _max(arr):
+        return arr.max()
+
+    @njit(cache=True, parallel=True, fastmath={'reassoc', 'contract'})
+    def _mean(arr, initial):
+        total = initial
+        for i in prange(arr.size):
+            total += arr[i]
+        return total / arr.size
+
+
+    def reduce_sum(arr):
+        flat = _flatten(arr)
+        if flat is None:
+            return _numpy_sum(arr)
+        return _as_dtype(_sum(flat, _sum_accumulator(arr.dtype)), arr.dtype)
+
+    def reduce_min(arr):
+        flat = _flatten(arr)
+        if flat is None:
+            return np.min(arr)
+        return arr.dtype.type(_min(flat))
+
+    def reduce_max(arr):
+        flat = _flatten(arr)
+        if flat is None:
+            return np.max(arr)
+        return arr.dtype.type(_max(flat))
+
+    def reduce_mean(arr):
+        flat = _flatten(arr)
+        if flat is None:
+            return _numpy_mean(arr)
+        # Sum and divide in a single pass then cast once at the end
+        return arr.dtype.type(_mean(flat, _mean_accumulator(arr.dtype)))
+
+    def sum_total(arr):
+        flat = _flatten(arr)
+        if flat is None:
+            return np.sum(arr, dtype=_sum_accumulator(arr.dtype).dtype)
+        initial = _sum_accumulator(arr.dtype)
+        return _as_dtype(_sum(flat, initial), initial.dtype)
+
+    def mean_total(arr):
+        flat = _flatten(arr)
+        if flat is None:
+            return np.sum(arr, dtype=_mean_accumulator(arr.dtype).dtype)
+        return _sum(flat, _mean_accumulator(arr.dtype))
+
+    def accumulate_sum(acc, arr):
+        """
+        Adds the sum of the array onto a 0-d accumulator array in place. Takes
+        the same arguments as a Reducer's accumulate so it can be used directly.
+        """
+        flat = _flatten(arr)
+        if flat is None:
+            return np.add(acc, np.sum(arr, dtype=acc.dtype), out=acc)
+        # The kernel starts from the running total so no separate fold is needed
+        acc[...] = _as_dtype(_sum(flat, acc[()]), acc.dtype)
+        return acc
+
+
+    def compile_kernels(dtypes):
+        """
+        Compiles every kernel for each of the given dtypes up front (or loads
+        it from numba's on-disk cache) so the first request doesn't pay for it.
+        """
+        for dtype in map(np.dtype, dtypes):
+            item = from_dtype(dtype)
+            sum_accumulator = from_dtype(_sum_accumulator(dtype).dtype)
+            mean_accumulator = from_dtype(_mean_accumulator(dtype).dtype)
+            # Streamed chunks are read-only views over the response bytes,
+            # which numba types separately from writable arrays
+            for arr in (item[::1], types.Array(item, 1, 'C', readonly=True)):
+                _sum.compile((arr, sum_accumulator))
+                _sum.compile((arr, mean_accumulator))
+                _min.compile((arr,))
+                _max.compile((arr,))
+                _mean.compile((arr, mean_accumulator))
+
+else:
+
+    reduce_sum = _numpy_sum
+
+    reduce_min = np.min
+    reduce_max = np.max
+
+    reduce_mean = _numpy_mean
+
+    def sum_total(arr):
+        return np.sum(arr, dtype=_sum_accumulator(arr.dtype).dtype)
+
+    def mean_total(arr):
+        return np.sum(arr, dtype=_mean_accumulator(arr.dtype).dtype)
+
+    def accumulate_sum(acc, arr):
+        return np.add(acc, np.sum(arr, dtype=acc.dtype), out=acc)
+
+    def compile_kernels(dtypes):
+        pass
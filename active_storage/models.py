@@ -1,11 +1,13 @@
 
 from enum import Enum
-from typing import Optional, List
+from typing import Optional, List, Callable, Literal
 from dataclasses import dataclass
 
-from pydantic import BaseModel, Field, constr, conint, conlist
+from pydantic import BaseModel, Field, validator, root_validator
 import numpy as np
 
+from . import kernels
+
 
 #Use enum which also subclasses string type so that 
 # auto-generated OpenAPI schema can determine allowed dtypes
@@ -20,20 +22,85 @@ class AllowedDatatypes(str, Enum):
 
     def n_bytes(self):
         """ Returns the number of bytes in the data type """
-        return np.dtype(self.name).itemsize
+        return _NBYTES[self.name]
+
+    def np_dtype(self):
+        """ Returns the equivalent numpy dtype """
+        return _NP_DTYPE[self.name]
+
+
+#Precomputed per-dtype lookups to avoid constructing np.dtype objects per request,
+# derived from the enum so that they always cover every allowed dtype
+_NP_DTYPE = {name: np.dtype(name) for name in AllowedDatatypes.__members__}
+_NBYTES = {name: dtype.itemsize for name, dtype in _NP_DTYPE.items()}
 
 
 class RequestData(BaseModel):
-    source: constr(min_length=1)
-    bucket: constr(min_length=1)
-    object: constr(min_length=1)
+    source: str
+    bucket: str
+    object: str
     dtype: AllowedDatatypes
-    offset: Optional[conint(ge=0)]
+    #Bounds are checked by the validators below rather than constrained
+    # types, which are much slower to parse, so only add them to the schema
+    offset: Optional[int] = Field(None, minimum=0)
     #Use example kwarg for OpenAPI generated schema
-    size: Optional[conint(ge=1)] = Field(example=1024)
-    shape: Optional[conlist(item_type=conint(ge=1), min_items=1)]
-    order: str = 'C'
-    selection: Optional[List[conlist(item_type=conint(ge=0), max_items=3, min_items=3)]]
+    size: Optional[int] = Field(None, example=1024, minimum=1)
+    shape: Optional[List[int]]
+    order: Literal['C', 'F'] = 'C'
+    selection: Optional[List[List[int]]]
+
+    @validator('source', 'bucket', 'object')
+    def check_not_empty(cls, v):
+        if not v:
+            raise ValueError('ensure this value has at least 1 characters')
+        return v
+
+    @validator('offset')
+    def check_offset(cls, v):
+        if v is not None and v < 0:
+            raise ValueError('ensure this value is greater than or equal to 0')
+        return v
+
+    @validator('size')
+    def check_size(cls, v):
+        if v is not None and v < 1:
+            raise ValueError('ensure this value is greater than or equal to 1')
+        return v
+
+    @validator('shape')
+    def check_shape(cls, v):
+        if v is not None:
+            if len(v) < 1:
+                raise ValueError('ensure this value has at least 1 items')
+            if not all(n >= 1 for n in v):
+                raise ValueError('ensure all elements are greater than or equal to 1')
+        return v
+
+    @validator('selection')
+    def check_selection(cls, v):
+        if v is not None and not all(len(s) == 3 and all(x >= 0 for x in s) for s in v):
+            raise ValueError('ensure each element is a list of 3 integers greater than or equal to 0')
+        return v
+
+    #Cross-field checks live here too so each request is validated in a single pass
+    @root_validator(skip_on_failure=True)
+    def check_consistency(cls, values):
+        dtype = values['dtype']
+        offset = values['offset']
+        if offset is not None and offset % dtype.n_bytes() != 0:
+            raise ValueError(' '.join([
+                'Offset parameter must be divisible by number of bytes in dtype',
+                f'(i.e. {dtype.n_bytes()} for dtype {dtype.value}).',
+                f'Given offset = {offset}',
+            ]))
+
+        shape = values['shape']
+        selection = values['selection']
+        if shape is None and selection is not None:
+            raise ValueError('When providing a selection parameter you must also provide an shape parameter')
+        if selection and len(shape) != len(selection):
+            raise ValueError('Selection parameter list must have same number of elements as shape parameter')
+        return values
 
 
 #Use enum which also subclasses string type so that 
@@ -47,11 +114,94 @@ class AllowedReductions(str, Enum):
     select = 'select'
     mean = 'mean'
 
+
+@dataclass(frozen=True)
+class Reducer:
+    """
+    A reduction operation. Operations which can also be applied chunk by chunk
+    provide a chunk reducer whose first partial result is turned into an
+    accumulator by `start`, which later partial results are folded into using
+    `combine`, and which is converted into the final result by `finalise`.
+    Operations with a kernel that takes the running accumulator can also
+    provide `accumulate` to fold later chunks in directly.
+    """
+    reduce: Callable
+    reduce_chunk: Optional[Callable] = None
+    start: Callable = lambda partial: partial
+    combine: Optional[Callable] = None
+    accumulate: Optional[Callable] = None
+    finalise: Callable = lambda result, dtype: result
+    #Whether folding chunks in any order gives exactly the same result for floats
+    # (integer folds always do since integer addition is associative)
+    order_independent: bool = False
+
+    @property
+    def streamable(self):
+        return self.combine is not None
+
+    def is_order_independent(self, dtype: np.dtype):
+        """ Whether chunks of the given dtype can be folded in any order """
+        return self.order_independent or dtype.kind in 'iu'
+
+
+def _fold_into(ufunc):
+    """ Returns a combine function which folds partial results into a 0-d array accumulator in place """
+    return lambda acc, partial: ufunc(acc, partial, out=acc)
+
+
+def _combine_mean(acc, partial):
+    np.add(acc[0], partial[0], out=acc[0])
+    acc[1] += partial[1]
+    return acc
+
+
+def _accumulate_mean(acc, arr):
+    kernels.accumulate_sum(acc[0], arr)
+    acc[1] += arr.size
+    return acc
+
+
+#Keyed on the enum members themselves so lookups with the validated
+# path parameter match by identity
 REDUCERS = {
-    'sum': lambda arr: np.sum(arr, dtype=arr.dtype),
-    'min': np.min,
-    'max': np.max,
-    'count': lambda arr: np.prod(arr.shape, dtype = 'int64'), #Force specific dtype
-    'select': lambda arr: arr,
-    'mean': lambda arr: (np.sum(arr) / np.size(arr)).astype(arr.dtype),
+    AllowedReductions.sum: Reducer(
+        reduce=kernels.reduce_sum,
+        # Keep the running total in the wider accumulator type until the end
+        reduce_chunk=kernels.sum_total,
+        start=np.array,
+        combine=_fold_into(np.add),
+        accumulate=kernels.accumulate_sum,
+        finalise=lambda acc, dtype: acc.astype(dtype),
+    ),
+    AllowedReductions.min: Reducer(
+        reduce=kernels.reduce_min,
+        reduce_chunk=kernels.reduce_min,
+        start=np.array,
+        combine=_fold_into(np.minimum),
+        order_independent=True,
+    ),
+    AllowedReductions.max: Reducer(
+        reduce=kernels.reduce_max,
+        reduce_chunk=kernels.reduce_max,
+        start=np.array,
+        combine=_fold_into(np.maximum),
+        order_independent=True,
+    ),
+    AllowedReductions.count: Reducer(
+        reduce=lambda arr: np.prod(arr.shape, dtype = 'int64'), #Force specific dtype
+        reduce_chunk=lambda arr: arr.size,
+        start=lambda partial: np.array(partial, dtype='int64'),
+        combine=_fold_into(np.add),
+        order_independent=True,
+    ),
+    AllowedReductions.select: Reducer(reduce=lambda arr: arr),
+    AllowedReductions.mean: Reducer(
+        reduce=kernels.reduce_mean,
+        # Track a running (sum, count) pair and only divide once at the end
+        reduce_chunk=lambda arr: (kernels.mean_total(arr), arr.size),
+        start=lambda partial: [np.array(partial[0]), partial[1]],
+        combine=_combine_mean,
+        accumulate=_accumulate_mean,
+        finalise=lambda acc, dtype: (acc[0] / acc[1]).astype(dtype),
+    ),
 }
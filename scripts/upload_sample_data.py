@@ -16,9 +16,12 @@ try:
 except FileExistsError:
     pass
 
-# Create numpy arrays and upload to S3 as bytes
-for d in AllowedDatatypes.__members__.keys():
-    with s3_fs.open(bucket / f'data-{d}.dat', 'wb') as s3_file:
-        s3_file.write(np.arange(10, dtype=d).tobytes())
+# Create numpy arrays and upload them to S3 as bytes concurrently, since each
+# small upload is dominated by request overhead (s3fs runs them in parallel
+# when given a dict of paths)
+s3_fs.pipe({
+    str(bucket / f'data-{d}.dat'): np.arange(10, dtype=d).tobytes()
+    for d in AllowedDatatypes.__members__.keys()
+})
 
 print("Data upload successful. \nBucket contents:\n", s3_fs.ls(bucket))
\ No newline at end of file
@@ -0,0 +1,358 @@
+import asyncio
+import random
+
+import botocore.exceptions
+import numpy as np
+import pytest
+from fastapi import HTTPException
+from fastapi.security import HTTPBasicCredentials
+
+from active_storage.app import (
+    S3ClientCache,
+    build_pipeline,
+    generate_bytes_ranges,
+    iter_object_ranges,
+    selection_byte_ranges,
+    stream_reduce,
+    upstream_s3_response,
+)
+from active_storage.config import settings
+from active_storage.models import REDUCERS, AllowedDatatypes, AllowedReductions, RequestData
+
+
+def make_request(**kwargs):
+    return RequestData(source='http://s3', bucket='bucket', object='object', **kwargs)
+
+
+class FakeBody:
+
+    def __init__(self, data):
+        self.data = data
+
+    async def read(self):
+        # Let other fetches run so that results can arrive out of order
+        await asyncio.sleep(random.random() * 0.001)
+        return self.data
+
+
+class FakeS3Client:
+    """ Serves range requests for a single object and records the ranges requested """
+
+    def __init__(self, data):
+        self.data = data
+        self.requested = []
+
+    async def get_object(self, Bucket, Key, Range):
+        self.requested.append(Range)
+        start, stop = map(int, Range[len('bytes='):].split('-'))
+        if start >= len(self.data):
+            raise botocore.exceptions.ClientError(
+                {'Error': {'Code': 'InvalidRange'}, 'ResponseMetadata': {'HTTPStatusCode': 416}},
+                'GetObject',
+            )
+        stop = min(stop, len(self.data) - 1)
+        return {
+            'Body': FakeBody(self.data[start:stop + 1]),
+            'ContentLength': stop + 1 - start,
+            'ContentRange': f'bytes {start}-{stop}/{len(self.data)}',
+        }
+
+
+async def collect(chunks):
+    return [item async for item in chunks]
+
+
+def test_empty_selection_fetches_everything():
+    request_data = make_request(dtype='int64', size=24 * 8, shape=[4, 6], selection=[])
+    assert generate_bytes_ranges(request_data) is None
+
+
+def test_scattered_selection_fetches_everything():
+    # A single column of rows too far apart to coalesce needs a range request per row
+    request_data = make_request(dtype='float32', size=10000 * 10000 * 4, shape=[10000, 10000], selection=[[0, 10000, 1], [0, 1, 1]])
+    assert generate_bytes_ranges(request_data) is None
+
+
+def test_sparse_selection_fetches_ranges():
+    # A few rows far apart from each other
+    request_data = make_request(dtype='float32', size=1000 * 1000 * 4, shape=[1000, 1000], selection=[[0, 1000, 500], [0, 1000, 1]])
+    assert generate_bytes_ranges(request_data) == ((0, 4000), (2000000, 2004000))
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_selection_byte_ranges_match_indexing(monkeypatch, seed):
+    rng = random.Random(seed)
+    for _ in range(200):
+        monkeypatch.setattr(settings, 'coalesce_gap', rng.choice([0, 4, 16, 40, 100]))
+        monkeypatch.setattr(settings, 'chunk_size', rng.choice([8, 64, 128, 1 << 20]))
+        selection_byte_ranges.cache_clear()
+
+        dtype = AllowedDatatypes(rng.choice(['int32', 'float64', 'uint64']))
+        n_bytes = dtype.n_bytes()
+        order = rng.choice('CF')
+        shape = tuple(rng.randint(1, 7) for _ in range(rng.randint(1, 4)))
+        selection = tuple((rng.randint(0, n), rng.randint(0, n + 1), rng.randint(1, 4)) for n in shape)
+        ranges = selection_byte_ranges(dtype, order, shape, selection)
+
+        # Byte offsets of the selected elements, found by indexing an array of offsets
+        offsets = np.arange(int(np.prod(shape))) * n_bytes
+        selected = np.unique(offsets.reshape(shape, order=order)[tuple(slice(*s) for s in selection)])
+        if selected.size == 0:
+            assert ranges == ()
+            continue
+
+        # Ranges are ascending, don't overlap and are no bigger than a chunk
+        assert all(start < stop <= start + settings.chunk_size for start, stop in ranges)
+        assert all(prev[1] <= next[0] for prev, next in zip(ranges, ranges[1:]))
+
+        # Joining ranges split by chunk size back into runs, each run starts and
+        # ends on a selected element, the elements within a run are no more than
+        # the gap apart and the runs themselves are more than the gap apart
+        runs = [list(ranges[0])]
+        for start, stop in ranges[1:]:
+            if start == runs[-1][1]:
+                runs[-1][1] = stop
+            else:
+                runs.append([start, stop])
+        assert all(next[0] - prev[1] > settings.coalesce_gap for prev, next in zip(runs, runs[1:]))
+        for start, stop in runs:
+            within = selected[(selected >= start) & (selected < stop)]
+            assert within[0] == start and within[-1] + n_bytes == stop
+            assert np.all(np.diff(within) - n_bytes <= settings.coalesce_gap)
+        assert sum(len(selected[(selected >= start) & (selected < stop)]) for start, stop in runs) == selected.size
+
+        # Reading just those ranges gives the same selection as the full array
+        data = np.arange(int(np.prod(shape)), dtype=dtype.np_dtype()).tobytes()
+        buffer = bytearray(len(data))
+        for start, stop in ranges:
+            buffer[start:stop] = data[start:stop]
+        pipeline = build_pipeline(AllowedReductions.select, dtype, order, shape, selection)
+        assert pipeline(buffer) == build_pipeline(AllowedReductions.select, dtype, order, shape, selection)(bytearray(data))
+
+
+async def iter_chunks(data, sizes, shuffle=False):
+    """ Yields (position, chunk) pairs of the data split into chunks of the given sizes """
+    chunks = []
+    position = 0
+    for size in sizes:
+        chunks.append((position, data[position:position + size]))
+        position += size
+    if shuffle:
+        random.shuffle(chunks)
+    for chunk in chunks:
+        await asyncio.sleep(0)
+        yield chunk
+
+
+@pytest.mark.parametrize('operation', ['sum', 'min', 'max', 'count', 'mean'])
+@pytest.mark.parametrize('dtype', ['int32', 'float64', 'uint64'])
+def test_stream_reduce_carries_partial_elements(monkeypatch, operation, dtype):
+    # Use a small block size so that chunks are both gathered into blocks and reduced in place
+    monkeypatch.setattr(settings, 'reduce_block_size', 40)
+    dtype = AllowedDatatypes(dtype)
+    arr = np.arange(-50, 150).astype(dtype.np_dtype())
+    data = arr.tobytes()
+    rng = random.Random(0)
+    sizes = []
+    while sum(sizes) < len(data):
+        sizes.append(rng.choice([1, 3, 7, 13, 50, 64]))
+
+    reducer = REDUCERS[AllowedReductions(operation)]
+    result = asyncio.run(stream_reduce(iter_chunks(data, sizes), dtype, reducer))
+    expected = reducer.reduce(arr)
+    assert result.dtype == expected.dtype
+    assert result == expected
+
+
+@pytest.mark.parametrize('operation', ['min', 'max', 'count'])
+def test_stream_reduce_out_of_order(monkeypatch, operation):
+    monkeypatch.setattr(settings, 'reduce_block_size', 40)
+    dtype = AllowedDatatypes.float32
+    arr = np.arange(-50, 150).astype(dtype.np_dtype())
+    data = arr.tobytes()
+    # Out of order chunks always start on an element boundary
+    sizes = [random.choice([1, 5, 12]) * dtype.n_bytes() for _ in range(len(arr))]
+
+    reducer = REDUCERS[AllowedReductions(operation)]
+    result = asyncio.run(stream_reduce(iter_chunks(data, sizes, shuffle=True), dtype, reducer))
+    assert result == reducer.reduce(arr)
+
+
+def test_stream_reduce_rejects_partial_element():
+    chunks = iter_chunks(bytes(10), [3, 7])
+    with pytest.raises(HTTPException) as exc_info:
+        asyncio.run(stream_reduce(chunks, AllowedDatatypes.int64, REDUCERS[AllowedReductions.sum]))
+    assert exc_info.value.status_code == 400
+
+
+def test_stream_reduce_empty():
+    result = asyncio.run(stream_reduce(iter_chunks(b'', []), AllowedDatatypes.int32, REDUCERS[AllowedReductions.sum]))
+    assert result == 0
+
+
+@pytest.mark.parametrize('ordered', [True, False])
+def test_iter_object_ranges(monkeypatch, ordered):
+    monkeypatch.setattr(settings, 'max_concurrency', 4)
+    data = bytes(range(256)) * 4
+    s3_client = FakeS3Client(data)
+    request_data = make_request(dtype='int32', offset=16)
+    ranges = [(start, start + 48) for start in range(0, 960, 64)]
+
+    chunks = asyncio.run(collect(iter_object_ranges(s3_client, request_data, ranges, ordered)))
+    if ordered:
+        assert [position for position, _ in chunks] == [start for start, _ in ranges]
+    assert sorted(chunks) == [(start, data[16 + start:16 + stop]) for start, stop in ranges]
+
+
+def test_iter_object_ranges_window(monkeypatch):
+    monkeypatch.setattr(settings, 'max_concurrency', 4)
+    s3_client = FakeS3Client(bytes(6400))
+    ranges = [(start, start + 64) for start in range(0, 6400, 64)]
+
+    async def consume_one():
+        chunks = iter_object_ranges(s3_client, make_request(dtype='int32'), ranges)
+        await chunks.__anext__()
+        # A stalled consumer only lets the window run ahead of it
+        await asyncio.sleep(0.05)
+        await chunks.aclose()
+
+    asyncio.run(consume_one())
+    assert len(s3_client.requested) == settings.max_concurrency + 1
+
+
+def test_iter_object_ranges_stops_at_end_of_object(monkeypatch):
+    monkeypatch.setattr(settings, 'max_concurrency', 4)
+    data = bytes(1000)
+    s3_client = FakeS3Client(data)
+    ranges = [(start, start + 64) for start in range(0, 64 * 1000, 64)]
+
+    chunks = asyncio.run(collect(iter_object_ranges(s3_client, make_request(dtype='int32'), ranges)))
+    assert b''.join(chunk for _, chunk in chunks) == data
+    # Only the window in flight when the end of the object was found is wasted
+    assert len(s3_client.requested) <= len(data) // 64 + 1 + settings.max_concurrency
+
+
+def test_upstream_s3_response_clamps_to_object(monkeypatch):
+    monkeypatch.setattr(settings, 'chunk_size', 64)
+    data = bytes(range(250))
+    s3_client = FakeS3Client(data)
+    request_data = make_request(dtype='int32', offset=8, size=2 ** 40)
+
+    async def fetch():
+        size, chunks = await upstream_s3_response(s3_client, request_data)
+        return size, await collect(chunks)
+
+    size, chunks = asyncio.run(fetch())
+    assert size == len(data) - 8
+    assert b''.join(chunk for _, chunk in sorted(chunks)) == data[8:]
+    assert len(s3_client.requested) == 4
+
+
+def test_upstream_s3_response_single_request_for_small_object():
+    s3_client = FakeS3Client(bytes(100))
+
+    async def fetch():
+        size, chunks = await upstream_s3_response(s3_client, make_request(dtype='int32'))
+        return size, await collect(chunks)
+
+    size, chunks = asyncio.run(fetch())
+    assert size == 100 and chunks == [(0, bytes(100))]
+    assert s3_client.requested == [f'bytes=0-{settings.chunk_size - 1}']
+
+
+class FakeClientContext:
+
+    def __init__(self, name, closed):
+        self.name = name
+        self.closed = closed
+
+    async def __aenter__(self):
+        await asyncio.sleep(0)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.closed.append(self.name)
+
+
+class FakeSession:
+
+    def __init__(self):
+        self.closed = []
+        self.created = []
+
+    def client(self, service, endpoint_url, aws_access_key_id, **kwargs):
+        if not endpoint_url.startswith('http'):
+            raise ValueError(f'Invalid endpoint: {endpoint_url}')
+        self.created.append(aws_access_key_id)
+        return FakeClientContext(aws_access_key_id, self.closed)
+
+
+def credentials(username):
+    return HTTPBasicCredentials(username=username, password='secret')
+
+
+def make_cache(monkeypatch, max_cached_clients):
+    monkeypatch.setattr(settings, 'max_cached_clients', max_cached_clients)
+    cache = S3ClientCache()
+    cache.session = FakeSession()
+    return cache
+
+
+def test_client_cache_shares_clients(monkeypatch):
+    cache = make_cache(monkeypatch, 2)
+
+    async def run():
+        clients = await asyncio.gather(*[cache.acquire('http://s3', credentials('a')) for _ in range(5)])
+        for s3_client in clients:
+            await cache.release(s3_client)
+        return clients
+
+    clients = asyncio.run(run())
+    assert len(set(map(id, clients))) == 1
+    assert cache.session.created == ['a']
+    assert not cache.users and not cache.locks
+
+
+def test_client_cache_evicts_least_recently_used(monkeypatch):
+    cache = make_cache(monkeypatch, 2)
+
+    async def run():
+        for username in ['a', 'b', 'a', 'c']:
+            async with cache.client('http://s3', credentials(username)):
+                pass
+
+    asyncio.run(run())
+    assert cache.session.closed == ['b']
+    assert [key[1] for key in cache.clients] == ['a', 'c']
+
+
+def test_client_cache_closes_evicted_client_once_released(monkeypatch):
+    cache = make_cache(monkeypatch, 1)
+
+    async def run():
+        in_use = await cache.acquire('http://s3', credentials('a'))
+        async with cache.client('http://s3', credentials('b')):
+            pass
+        # Still in use so can't be closed yet
+        assert cache.session.closed == []
+        await cache.release(in_use)
+        assert cache.session.closed == ['a']
+        await cache.close()
+
+    asyncio.run(run())
+    assert cache.session.closed == ['a', 'b']
+    assert not cache.users and not cache.evicted
+
+
+def test_client_cache_drops_lock_when_creation_fails(monkeypatch):
+    cache = make_cache(monkeypatch, 2)
+
+    async def run():
+        results = await asyncio.gather(
+            *[cache.acquire('not-a-url', credentials('a')) for _ in range(3)],
+            return_exceptions=True,
+        )
+        assert all(isinstance(result, ValueError) for result in results)
+
+    asyncio.run(run())
+    assert not cache.clients and not cache.users and not cache.locks
@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+from active_storage import kernels
+
+
+@pytest.mark.parametrize('dtype', ['float32', 'float64'])
+@pytest.mark.parametrize('kernel, expected', [(kernels.reduce_min, np.min), (kernels.reduce_max, np.max)])
+def test_min_max_propagate_nan(kernel, expected, dtype):
+    arr = np.array([1, np.nan, 3, 0.5], dtype=dtype)
+    result = kernel(arr)
+    assert np.isnan(result) and np.isnan(expected(arr))
+    assert result.dtype == arr.dtype
+
+
+@pytest.mark.parametrize('dtype', ['float32', 'float64'])
+@pytest.mark.parametrize('kernel, expected', [(kernels.reduce_min, np.min), (kernels.reduce_max, np.max)])
+def test_min_max_match_numpy(kernel, expected, dtype):
+    arr = np.array([1, 4, 3, 0.5, -2], dtype=dtype)
+    assert kernel(arr) == expected(arr)
+
+
+@pytest.mark.parametrize('dtype', ['int32', 'uint32', 'int64', 'uint64'])
+def test_sum_wraps_on_overflow(dtype):
+    arr = np.full(10, np.iinfo(dtype).max, dtype=dtype)
+    expected = np.sum(arr, dtype=arr.dtype)
+    assert kernels.reduce_sum(arr) == expected
+    assert kernels.sum_total(arr) == expected
+
+    acc = np.array(arr[0])
+    kernels.accumulate_sum(acc, arr[1:])
+    assert acc == expected and acc.dtype == arr.dtype
+
+
+@pytest.mark.skipif(kernels.njit is None, reason='numba is not installed')
+@pytest.mark.parametrize('dtype', ['float32', 'int64'])
+def test_compiled_kernels_cover_readonly_arrays(dtype):
+    kernels.compile_kernels([dtype])
+    jitted = (kernels._sum, kernels._min, kernels._max, kernels._mean)
+    signatures = [len(kernel.signatures) for kernel in jitted]
+
+    # Streamed chunks arrive as read-only views over the response bytes
+    arr = np.frombuffer(np.arange(10, dtype=dtype).tobytes(), dtype=dtype)
+    assert not arr.flags.writeable
+    assert kernels.reduce_sum(arr) == np.sum(arr)
+    assert kernels.reduce_min(arr) == np.min(arr)
+    assert kernels.reduce_max(arr) == np.max(arr)
+    assert kernels.reduce_mean(arr) == np.mean(arr, dtype=arr.dtype)
+    kernels.accumulate_sum(np.zeros((), kernels._sum_accumulator(arr.dtype).dtype), arr)
+
+    assert [len(kernel.signatures) for kernel in jitted] == signatures